@@ -1,6 +1,17 @@
 #!/usr/bin/env python
 
-from setuptools import setup
+from setuptools import setup, Extension
+
+try:
+    from Cython.Build import cythonize
+
+    # optional, so that the pure Python implementation is used when there is no compiler
+    ext_modules = cythonize(
+        [Extension("target_parquet._flatten", ["target_parquet/_flatten.pyx"], optional=True)],
+        language_level=3,
+    )
+except ImportError:
+    ext_modules = []
 
 setup(
     name="target-parquet",
@@ -11,7 +22,8 @@ setup(
     classifiers=["Programming Language :: Python :: 3 :: Only"],
     py_modules=["target_parquet"],
     install_requires=[
-        "jsonschema==2.6.0",
+        "fastjsonschema==2.18.0",
+        "orjson==3.8.3",
         "singer-python==5.12.2",
         "pyarrow==7.0.0",
         "psutil==5.9.0",
@@ -19,7 +31,8 @@ setup(
     extras_require={
         'dev': [
             'pytest==6.2.4',
-            'pandas==1.4.1'
+            'pandas==1.4.1',
+            'Cython==0.29.28'
         ]
     },
     entry_points="""
@@ -27,4 +40,5 @@ setup(
           target-parquet=target_parquet:main
       """,
     packages=["target_parquet"],
+    ext_modules=ext_modules,
 )
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 import argparse
 from datetime import datetime
-from io import TextIOWrapper
+from io import BufferedReader
 import http.client
-import simplejson as json
-from jsonschema.validators import Draft4Validator
+import logging
+import orjson
+import fastjsonschema
 import os
 import pkg_resources
 import pyarrow as pa
@@ -17,78 +18,157 @@ import psutil
 import time
 import threading
 import gc
-import random
 from enum import Enum
-from multiprocessing import Process, Queue
+from multiprocessing import get_all_start_methods, get_context, Queue
+import queue
 
-from .helpers import flatten, flatten_schema
+from .helpers import flatten, flatten_schema, is_trivial_schema, json_fields
 
 _all__ = ["main"]
 
 LOGGER = singer.get_logger()
 LOGGER.setLevel(os.getenv("LOGGER_LEVEL", "INFO"))
 
-def extract_field_names(list_dict):
-    fields = set()
-    for d in list_dict:
-        fields = fields.union(d.keys())
-    LOGGER.info(f"final list of fields: {fields}")
-    return fields
+def create_column(values, field_type):
+    """Converts the values of a field to an Arrow array of the given type, inferred when None.
+    Unlike the conversion to integers, which truncates the floats, a float with a fractional part is rejected"""
+    if field_type is None or not pa.types.is_integer(field_type):
+        return pa.array(values, type=field_type)
+    column = pa.array(values)
+    if pa.types.is_floating(column.type):
+        # safe by default, so only the integral floats are converted
+        return column.cast(field_type)
+    if column.type != field_type:
+        column = pa.array(values, type=field_type)
+    return column
 
 def create_dataframe(list_dict, fields, dataframe_schema):
+    """Converts the records to an Arrow record batch. Without a schema, the fields are given as pairs of
+    names and types, and only the types which are None are inferred from the records"""
     try:
         if dataframe_schema is None:
-            dataframe = pa.table({f: [row.get(f, None) for row in list_dict] for f in fields})
-            for i in range(len(fields)):
-                new_field_with_nullable = dataframe.schema.field(i).with_nullable(True)
-                dataframe.schema.set(i, new_field_with_nullable)
-            dataframe = pa.table({f: [row.get(f, None) for row in list_dict] for f in fields}, schema=dataframe.schema)
-        else: 
-            dataframe = pa.table({f: [row.get(f, None) for row in list_dict] for f in fields}, schema=dataframe_schema)
-       # dataframe = pa.Table.from_pylist(list_dict)
+            dataframe = pa.RecordBatch.from_arrays(
+                [create_column([row.get(f) for row in list_dict], field_type) for f, field_type in fields],
+                names=[f for f, _ in fields],
+            )
+        else:
+            dataframe = pa.RecordBatch.from_arrays(
+                [create_column([row.get(field.name) for row in list_dict], field.type) for field in dataframe_schema],
+                schema=dataframe_schema,
+            )
     except Exception as e:
         LOGGER.info(f"exception for data frame: {e}")
         raise
     return dataframe
 
-def get_schema(list_dict, fields):
-    try:
-       dataframe = pa.table({f: [row.get(f, None) for row in list_dict] for f in fields})
-       # dataframe = pa.Table.from_pylist(list_dict)
-    except Exception as e:
-        LOGGER.info(f"exception for schema: {e}")
-        raise
-    return dataframe.schema
+def merge_schemas(schemas):
+    """Merges the schemas of record batches whose columns may have been inferred with different types,
+    storing in floats the columns which have both integers and floats"""
+    fields = []
+    for column in zip(*schemas):
+        types = {field.type for field in column if not pa.types.is_null(field.type)}
+        if len(types) > 1 and all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+            types = {pa.float64()}
+        if len(types) > 1:
+            raise ValueError(f"The values of field {column[0].name} have incompatible types: {types}")
+        fields.append(column[0].with_type(types.pop() if types else pa.null()))
+    return pa.schema(fields)
+
+def compression_ratio(dataframe, compression_method, compression_level=None, sample_size=1000):
+    """Estimates how much the compression method shrinks the data frame, by compressing
+    its first rows serialized in the Arrow IPC format.
+    Returns the compressed to uncompressed size ratio, or None if the codec is not available"""
+    codec_name = compression_method.lower()
+    if not pa.Codec.is_available(codec_name):
+        return None
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, dataframe.schema) as writer:
+        writer.write_table(dataframe.slice(0, sample_size))
+    sample = sink.getvalue()
+    compressed = pa.Codec(codec_name, compression_level=compression_level).compress(sample)
+    return compressed.size / sample.size
+
+def dictionary_encode(dataframe, threshold):
+    """Dictionary encodes the string columns of the data frame which have fewer distinct values
+    than the given ratio of its rows"""
+    for i, field in enumerate(dataframe.schema):
+        if pa.types.is_string(field.type) and dataframe.num_rows:
+            column = dataframe.column(i)
+            # a column without values yet tells nothing about its cardinality
+            if 0 < compute.count_distinct(column).as_py() < threshold * dataframe.num_rows:
+                dataframe = dataframe.set_column(
+                    i,
+                    field.with_type(pa.dictionary(pa.int32(), pa.string())),
+                    column.dictionary_encode(),
+                )
+    return dataframe
+
+# off: records are not validated
+# lax: records are validated unless the schema only declares the types of the fields, which are then only
+#      checked when the records are converted to Arrow: the booleans sent for numbers are converted to 1 and 0,
+#      an object sent for a field of another type is dropped, and the fields without a single declared type
+#      are not checked
+# strict: records are always validated
+VALIDATION_MODES = ("off", "lax", "strict")
+
+# Draft of the schemas which do not declare theirs
+SINGER_SCHEMA_DRAFT = "http://json-schema.org/draft-04/schema#"
+
+def skip_validation(record):
+    pass
 
 class MessageType(Enum):
-    RECORD = 1
     STATE  = 2
     SCHEMA = 3
     EOF    = 4
+    RECORD_BATCH = 5
+    ABORT  = 6
+
+# Number of records sent at once to the consumer process, to spread the cost of pickling and locking the queue
+RECORD_BATCH_SIZE = 1000
+
+# Number of buffered records from which a stream is written when the records of another one come,
+# so that the streams are not all kept in memory, nor written in tiny row groups when they are interleaved
+STREAM_SWITCH_FLUSH_SIZE = 10000
 
 def emit_state(state):
     if state is not None:
-        line = json.dumps(state)
+        line = orjson.dumps(state).decode()
         LOGGER.info("Emitting state {}".format(line))
         sys.stdout.write("{}\n".format(line))
         sys.stdout.flush()
 
 
-class MemoryReporter(threading.Thread):
-    """Logs memory usage every 30 seconds"""
+class MemoryReporter:
+    """Logs memory usage when reported, at most every 30 seconds"""
 
-    def __init__(self):
+    def __init__(self, interval=30.0):
         self.process = psutil.Process()
-        super().__init__(name="memory_reporter", daemon=True)
+        self.total_memory = psutil.virtual_memory().total
+        self.interval = interval
+        self.last_report = None
 
-    def run(self):
-        while True:
-            LOGGER.info(
-                "Virtual memory usage: %.2f%% of total: %s",
-                self.process.memory_percent(),
-                self.process.memory_info(),
-            )
-            time.sleep(30.0)
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and self.last_report is not None and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        memory_info = self.process.memory_info()
+        LOGGER.info(
+            "Virtual memory usage: %.2f%% of total: %s",
+            100.0 * memory_info.rss / self.total_memory,
+            memory_info,
+        )
+
+
+class DirectQueue:
+    """Hands each message to the consumer as soon as it is put, when the consumer runs in the producer's process"""
+
+    def __init__(self, consume):
+        self.consume = consume
+
+    def put(self, message, timeout=None):
+        self.consume(message)
 
 
 def persist_messages(
@@ -97,200 +177,397 @@ def persist_messages(
     compression_method=None,
     streams_in_separate_folder=False,
     file_size=-1,
+    row_group_size=-1,
+    validation_mode="strict",
+    compression_level=None,
+    compression_skip_threshold=None,
+    memory_reporter=False,
+    dictionary_encode_threshold=0,
+    use_dictionary=True,
+    aggressive_gc=False,
 ):
     ## Static information shared among processes
     schemas = {}
     key_properties = {}
     validators = {}
+    # JSON schemas the validators were compiled from
+    stream_schemas = {}
+    # flattened names of the fields whose objects are stored as JSON
+    json_field_names = {}
 
-    compression_extension = ""
     if compression_method:
-        # The target is prepared to accept all the compression methods provided by the pandas module, with the mapping below,
-        extension_mapping = {
-            "SNAPPY": ".snappy",
-            "GZIP": ".gz",
-            "BROTLI": ".br",
-            "ZSTD": ".zstd",
-            "LZ4": ".lz4",
-        }
-        compression_extension = extension_mapping.get(compression_method.upper())
-        if compression_extension is None:
+        # The target is prepared to accept all the compression methods provided by the pandas module.
+        # The files keep the .parquet extension, as the compression is internal to the parquet format.
+        if compression_method.upper() not in ("SNAPPY", "GZIP", "BROTLI", "ZSTD", "LZ4"):
             LOGGER.info("unsuported compression method.")
-            compression_extension = ""
             compression_method = None
+        elif compression_level is None and compression_method.upper() == "ZSTD":
+            # level 3 is a good tradeoff between the file size and the time spent compressing
+            compression_level = 3
+    if validation_mode not in VALIDATION_MODES:
+        LOGGER.info("unsupported validation mode, using strict.")
+        validation_mode = "strict"
     filename_separator = "-"
     if streams_in_separate_folder:
         LOGGER.info("writing streams in separate folders")
         filename_separator = os.path.sep
-    if not os.path.exists(destination_path):
-        os.makedirs(destination_path)
+    destination_path = os.path.expanduser(destination_path)
+    os.makedirs(destination_path, exist_ok=True)
+    # path of the stream files up to their timestamp, set once the stream folder exists
+    file_prefixes = {}
+    dataframe_schemas = {}
+    # streams whose low cardinality string columns were already looked for
+    encoded_streams = set()
+    writers = {}
     ## End of Static information shared among processes
 
     # Object that signals shutdown
     _break_object = object()
 
-    def producer(message_buffer: TextIOWrapper, w_queue: Queue):
+    def send(w_queue, message):
+        # The queue is bounded, so make sure not to wait forever on a consumer that is gone
+        while True:
+            try:
+                return w_queue.put(message, timeout=1.0)
+            except queue.Full:
+                if not t2.is_alive():
+                    raise Exception("The parquet writer process stopped unexpectedly")
+
+    def producer(message_buffer: BufferedReader, w_queue: Queue):
         state = None
+        # records waiting to be sent, for each stream, so that interleaved streams are still sent in full batches
+        batches = {}
+        # bound once, as they are used for every record
+        flatten_record = flatten
+        batch_size = RECORD_BATCH_SIZE
+
+        def send_batches():
+            for stream_name in list(batches):
+                send(w_queue, (MessageType.RECORD_BATCH, stream_name, batches.pop(stream_name)))
+
+        def on_record(message):
+            nonlocal state
+            stream_name = message["stream"]
+            validator = validators.get(stream_name)
+            if validator is None:
+                raise ValueError(
+                    "A record for stream {} was encountered before a corresponding schema".format(
+                        stream_name
+                    )
+                )
+            record = message["record"]
+            validator(record)
+            flattened_record = flatten_record(record, json_fields=json_field_names[stream_name])
+            # Once the record is flattenned, it is added to the final record list, which will be stored in the parquet file.
+            batch = batches.get(stream_name)
+            if batch is None:
+                batch = batches[stream_name] = []
+            batch.append(flattened_record)
+            if len(batch) >= batch_size:
+                send(w_queue, (MessageType.RECORD_BATCH, stream_name, batches.pop(stream_name)))
+            state = None
+
+        def on_state(message):
+            nonlocal state
+            LOGGER.info("Setting state to {}".format(message["value"]))
+            state = message["value"]
+
+        def on_schema(message):
+            stream = message["stream"]
+            key_properties[stream] = message["key_properties"]
+            if stream_schemas.get(stream) == message["schema"]:
+                # Taps may send the schema again before each page of records, and compiling it takes milliseconds
+                return
+            stream_schemas[stream] = message["schema"]
+            if validation_mode == "off" or \
+               (validation_mode == "lax" and is_trivial_schema(message["schema"])):
+                validators[stream] = skip_validation
+            else:
+                schema = message["schema"]
+                if "$schema" not in schema:
+                    # Singer schemas follow draft 4, e.g. with boolean exclusiveMaximum,
+                    # while fastjsonschema applies the latest draft it supports by default
+                    schema = {"$schema": SINGER_SCHEMA_DRAFT, **schema}
+                # Records are only checked against the schema: formats are not enforced
+                # and defaults are not filled in
+                validators[stream] = fastjsonschema.compile(
+                    schema, use_default=False, use_formats=False
+                )
+            schemas[stream] = flatten_schema(message["schema"]["properties"])
+            json_field_names[stream] = json_fields(message["schema"]["properties"])
+            LOGGER.info(f"Schema: {schemas[stream]}")
+            # the records received so far belong to the previous schema
+            send_batches()
+            send(w_queue, (MessageType.SCHEMA, stream, schemas[stream]))
+
+        def on_unknown(message):
+            LOGGER.info(
+                "Unknown message type {} in message {}".format(
+                    message["type"], message
+                )
+            )
+
+        handlers = {
+            "RECORD": on_record,
+            "STATE": on_state,
+            "SCHEMA": on_schema,
+        }
+
+        # Local names for the lookups done on every message
+        loads = orjson.loads
+        JSONDecodeError = orjson.JSONDecodeError
+        get_handler = handlers.get
+        debug = LOGGER.debug if LOGGER.isEnabledFor(logging.DEBUG) else None
+
         try:
             for message in message_buffer:
-                LOGGER.debug(f"target-parquet got message: {message}")
+                if debug is not None:
+                    debug("target-parquet got message: %s", message)
                 try:
-                    message = singer.parse_message(message).asdict()
-                except json.decoder.JSONDecodeError:
+                    message = loads(message)
+                except JSONDecodeError:
                     raise Exception("Unable to parse:\n{}".format(message))
-
-                message_type = message["type"]
-                if message_type == "RECORD":
-                    if message["stream"] not in schemas:
-                        raise ValueError(
-                            "A record for stream {} was encountered before a corresponding schema".format(
-                                message["stream"]
-                            )
-                        )
-                    stream_name = message["stream"]
-                    validators[message["stream"]].validate(message["record"])
-                    flattened_record = flatten(message["record"])
-                    # Once the record is flattenned, it is added to the final record list, which will be stored in the parquet file.
-                    w_queue.put((MessageType.RECORD, stream_name, flattened_record))
-                    state = None
-                elif message_type == "STATE":
-                    LOGGER.info("Setting state to {}".format(message["value"]))
-                    state = message["value"]
-                elif message_type == "SCHEMA":
-                    stream = message["stream"]
-                    validators[stream] = Draft4Validator(message["schema"])
-                    schemas[stream] = flatten_schema(message["schema"]["properties"])
-                    LOGGER.info(f"Schema: {schemas[stream]}")
-                    key_properties[stream] = message["key_properties"]
-                    w_queue.put((MessageType.SCHEMA, stream, schemas[stream]))
-                else:
-                    LOGGER.info(
-                        "Unknown message type {} in message {}".format(
-                            message["type"], message
-                        )
-                    )
-            w_queue.put((MessageType.EOF, _break_object, None))
+                get_handler(message["type"], on_unknown)(message)
+            send_batches()
+            send(w_queue, (MessageType.EOF, _break_object, None))
             return state
         except Exception as Err:
-            w_queue.put((MessageType.EOF, _break_object, None))
+            if t2 is None or t2.is_alive():
+                # The records sent so far must not be written as if the run had succeeded
+                send(w_queue, (MessageType.ABORT, _break_object, None))
             LOGGER.info(f"exception in processing {Err}")
             raise Err
 
-    def write_file(current_stream_name, record):
-        
-        batch_size = 9704
+    def open_file(current_stream_name, dataframe):
+        file_prefix = file_prefixes.get(current_stream_name)
+        if file_prefix is None:
+            if streams_in_separate_folder:
+                os.makedirs(os.path.join(destination_path, current_stream_name), exist_ok=True)
+            file_prefix = file_prefixes[current_stream_name] = os.path.join(
+                destination_path, current_stream_name + filename_separator
+            )
+        file_compression_method = compression_method
+        if compression_method and compression_skip_threshold:
+            ratio = compression_ratio(dataframe, compression_method, compression_level)
+            if ratio is not None and ratio > compression_skip_threshold:
+                # Not worth making the readers decompress the file
+                LOGGER.info(f"skipping compression for {current_stream_name}, compression ratio is {ratio:.2f}")
+                file_compression_method = None
         timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S-%f")
+        filepath = file_prefix + timestamp + ".parquet"
+        LOGGER.info(f"starting to write parquet file {filepath}")
+        # All the row groups of a file are written with the schema of its first one.
+        # Each entry holds the writer, the file path and the number of rows written so far.
+        writers[current_stream_name] = [
+            ParquetWriter(
+                filepath,
+                dataframe.schema,
+                compression=file_compression_method,
+                compression_level=compression_level if file_compression_method else None,
+                use_dictionary=use_dictionary,
+            ),
+            filepath,
+            0,
+        ]
+        return filepath
+
+    def close_file(current_stream_name):
+        writer, filepath, _ = writers.pop(current_stream_name)
+        writer.close()
+        LOGGER.info(f"wrote parquet for {filepath}")
+        return filepath
+
+    def remove_unfinished_files():
+        """Removes the files which are still open, as the next run will write their records again"""
+        for stream_name in list(writers):
+            writer, filepath, _ = writers.pop(stream_name)
+            try:
+                writer.close()
+            except Exception as e:
+                LOGGER.info(f"exception: {e}")
+            os.remove(filepath)
+            LOGGER.info(f"removed unfinished parquet file {filepath}")
+
+    def write_file(current_stream_name, batches):
+        """Writes the buffered record batches as a row group of the stream's current file,
+        returning the path of a newly opened file, or None when appending to an open one"""
         LOGGER.info(f"Writing files from {current_stream_name} stream")
-        fields = extract_field_names(record)
+        filepath = None
+        schema = dataframe_schemas.get(current_stream_name)
+        if schema is None:
+            # the types of the fields without a declared one were inferred from the records of each batch
+            schema = merge_schemas([batch.schema for batch in batches])
+        if all(batch.schema.equals(schema) for batch in batches):
+            dataframe = pa.Table.from_batches(batches, schema)
+        else:
+            dataframe = pa.concat_tables([pa.Table.from_batches([batch]).cast(schema) for batch in batches])
+        if dictionary_encode_threshold and current_stream_name not in encoded_streams:
+            # decided on the first row group, the following batches are built with the same schema
+            dataframe = dictionary_encode(dataframe, dictionary_encode_threshold)
+        if not any(pa.types.is_null(field.type) for field in dataframe.schema):
+            encoded_streams.add(current_stream_name)
+            if current_stream_name in dataframe_schemas:
+                dataframe_schemas[current_stream_name] = dataframe.schema
+        writer = writers.get(current_stream_name)
+        if writer is not None and not writer[0].schema.equals(dataframe.schema):
+            try:
+                # the types inferred for the open file, or the string columns it dictionary encodes
+                dataframe = dataframe.cast(writer[0].schema)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                # the open file was started with columns that had only null values, or integers now given floats
+                close_file(current_stream_name)
+                writer = None
+        if writer is None:
+            filepath = open_file(current_stream_name, dataframe)
+            writer = writers[current_stream_name]
         LOGGER.info(f"data frame created")
-        
-        if streams_in_separate_folder and not os.path.exists(
-            os.path.join(destination_path, current_stream_name)
-        ):
-            os.makedirs(os.path.join(destination_path, current_stream_name))
-        filename = (
-            current_stream_name
-            + filename_separator
-            + timestamp
-        )
-     
-        filepath = os.path.expanduser(os.path.join(destination_path, filename))
-        dataframe_schema = None
-        # random.shuffle(record)
-        
-        batches_schema = []
-        for row_number in range(0, len(record), batch_size):
-             schema = get_schema(record[row_number:row_number+batch_size], fields)
-             batches_schema.append(schema)
-             # LOGGER.info(f"get_schema: {schema}")
-        schema = pa.unify_schemas(batches_schema)
-             
-        LOGGER.info(f"filepath will be {filepath}")
-        for row_number in range(0, len(record), batch_size):
-            file_part = filepath + "." + str(row_number)+ ".parquet"+ compression_extension
-            with open(file_part, 'wb') as f:
-                LOGGER.info(f"starting to write parquet file {filepath}");
-                try:
-                    dataframe = create_dataframe(record[row_number:row_number+batch_size], fields, schema)
-                    # using the same schema for all of the files
-                    # if schema is None:
-                        # schema = dataframe.schema;
-                    ParquetWriter(f,
-                                schema,
-                                compression=compression_method).write_table(dataframe)
-                    LOGGER.info(f"wrote parquet for {file_part}");
-                    ## explicit memory management. This can be usefull when working on very large data groups
-                    del dataframe
-                except Exception as e:
-                    LOGGER.info(f"exception: {e}");
-                    raise
-
-        LOGGER.info(f"returning the filepath {filepath}");
+        try:
+            writer[0].write_table(
+                dataframe, row_group_size=row_group_size if row_group_size > 0 else None
+            )
+            writer[2] += dataframe.num_rows
+        except Exception as e:
+            LOGGER.info(f"exception: {e}")
+            raise
+        ## explicit memory management. This can be usefull when working on very large data groups
+        del dataframe
         return filepath
 
-    def consumer(receiver):
+    def message_consumer():
+        """Returns the function handling the messages of the producer, which tells whether more are expected"""
         files_created = []
-        current_stream_name = None
-        # records is a list of dictionary of lists of dictionaries that will contain the records that are retrieved from the tap
-        records = {}
+        # created here to report on the consumer process
+        reporter = MemoryReporter() if memory_reporter else None
+        # record_batches holds, for each stream, the Arrow record batches converted from the records retrieved from the tap
+        record_batches = {}
+        row_counts = {}
         schemas = {}
+        current_stream_name = None
 
-        while True:
-            (message_type, stream_name, record) = receiver.get()  # q.get()
-            if message_type == MessageType.RECORD:
-                if (stream_name != current_stream_name) and (current_stream_name != None):
-                    files_created.append(
-                        write_file(
-                            current_stream_name,
-                            records.pop(current_stream_name)
-                        )
-                    )
-                    ## explicit memory management. This can be usefull when working on very large data groups
-                    gc.collect()
-                current_stream_name = stream_name
-                if type(records.get(stream_name)) != list:
-                    records[stream_name] = [record]
-                else:
-                    records[stream_name].append(record)
-                    if (file_size > 0) and \
-                    (not len(records[stream_name]) % file_size):
-                        files_created.append(
-                            write_file(
-                                current_stream_name,
-                                records.pop(current_stream_name)
-                            )
-                        )
-                        gc.collect()
+        def buffer(stream_name, list_dict):
+            batch = create_dataframe(list_dict, schemas[stream_name], dataframe_schemas.get(stream_name))
+            record_batches.setdefault(stream_name, []).append(batch)
+            row_counts[stream_name] = row_counts.get(stream_name, 0) + batch.num_rows
+
+        def room(stream_name):
+            """Number of records that can be buffered before the stream has to be flushed, None if unlimited"""
+            limits = []
+            if row_group_size > 0:
+                limits.append(row_group_size - row_counts.get(stream_name, 0))
+            if file_size > 0:
+                file_rows = writers[stream_name][2] if stream_name in writers else 0
+                limits.append(file_size - file_rows - row_counts.get(stream_name, 0))
+            return min(limits) if limits else None
+
+        def flush(stream_name):
+            row_counts.pop(stream_name)
+            filepath = write_file(stream_name, record_batches.pop(stream_name))
+            if filepath is not None:
+                files_created.append(filepath)
+            if (file_size > 0) and (writers[stream_name][2] >= file_size):
+                close_file(stream_name)
+            if aggressive_gc:
+                ## explicit memory management. This can be usefull when working on very large data groups
+                gc.collect()
+                # Arrow buffers are not tracked by the garbage collector, ask the allocator to give them back
+                memory_pool = pa.default_memory_pool()
+                if hasattr(memory_pool, "release_unused"):  # missing from older pyarrow versions
+                    memory_pool.release_unused()
+            if reporter is not None:
+                reporter.report()
+
+        def consume(message):
+            nonlocal current_stream_name
+            (message_type, stream_name, record) = message
+            if message_type == MessageType.RECORD_BATCH:
+                if stream_name != current_stream_name:
+                    if row_counts.get(current_stream_name, 0) >= STREAM_SWITCH_FLUSH_SIZE:
+                        flush(current_stream_name)
+                    current_stream_name = stream_name
+                # The records are converted to Arrow as they come, split where the stream has to be flushed
+                while record:
+                    size = room(stream_name)
+                    if size is None or size >= len(record):
+                        buffer(stream_name, record)
+                        record = None
+                    else:
+                        buffer(stream_name, record[:size])
+                        record = record[size:]
+                    if size is not None and row_counts[stream_name] and room(stream_name) <= 0:
+                        flush(stream_name)
             elif message_type == MessageType.SCHEMA:
+                if schemas.get(stream_name) != record:
+                    if stream_name in record_batches:
+                        # the buffered batches were built for the previous schema
+                        flush(stream_name)
+                    if stream_name in writers:
+                        close_file(stream_name)
+                    if all(field_type is not None for _, field_type in record):
+                        dataframe_schemas[stream_name] = pa.schema(record)
+                    else:
+                        # the types of some columns are inferred from the records of each batch
+                        dataframe_schemas.pop(stream_name, None)
+                    encoded_streams.discard(stream_name)
                 schemas[stream_name] = record
             elif message_type == MessageType.EOF:
                 try:
-                    LOGGER.info(f"Writing {current_stream_name} files")
-                    # LOGGER.info(f"Writing {records.pop(current_stream_name)} files")
-                    
-                    files_created.append(
-                        write_file(
-                            current_stream_name,
-                            records.pop(current_stream_name)
-                        )
-                    )
+                    for stream_name in list(record_batches):
+                        flush(stream_name)
+                    for stream_name in list(writers):
+                        close_file(stream_name)
+                    if reporter is not None:
+                        reporter.report(force=True)
                     LOGGER.info(f"Wrote {len(files_created)} files")
                     LOGGER.info(f"Wrote {files_created} files")
-                    break
+                    return False
                 except Exception as Err:
                     LOGGER.error(Err)
                     raise Err
-                    
-
-    q = Queue()
-    #t2 = Process(
-    #    target=consumer,
-    #    args=(q,),
-    #)
-    #t2.start()
-    state = producer(messages, q)
-    consumer(q)
-    # t2.join()
+            elif message_type == MessageType.ABORT:
+                # The buffered records are dropped. The files already completed with file_size are kept.
+                record_batches.clear()
+                row_counts.clear()
+                remove_unfinished_files()
+                return False
+            return True
+
+        return consume
+
+    def consumer(receiver):
+        consume = message_consumer()
+        try:
+            while consume(receiver.get()):  # q.get()
+                pass
+        except Exception:
+            # The open files could not be read, as their footer is only written when they are closed
+            remove_unfinished_files()
+            raise
+
+    if "fork" not in get_all_start_methods():
+        # The consumer relies on the closures above, which only a forked process inherits,
+        # so it runs in this process on the platforms without fork, e.g. Windows
+        LOGGER.info("fork is not available, writing the parquet files in the same process")
+        t2 = None
+        return producer(messages, DirectQueue(message_consumer()))
+
+    context = get_context("fork")
+    # Bounds the memory to about 100 batches of records waiting to be written
+    q = context.Queue(maxsize=100)
+    t2 = context.Process(
+        target=consumer,
+        args=(q,),
+    )
+    t2.start()
+    try:
+        state = producer(messages, q)
+    except Exception:
+        # Whatever is left in the queue will not be read if the consumer is gone
+        q.cancel_join_thread()
+        raise
+    finally:
+        t2.join()
+    if t2.exitcode != 0:
+        raise Exception(f"The parquet writer process failed with exit code {t2.exitcode}, see its error above")
     return state
 
 
@@ -320,8 +597,8 @@ def main():
 
     args = parser.parse_args()
     if args.config:
-        with open(args.config) as input_json:
-            config = json.load(input_json)
+        with open(args.config, "rb") as input_json:
+            config = orjson.loads(input_json.read())
     else:
         config = {}
         level = config.get("logging_level", None)
@@ -334,16 +611,23 @@ def main():
             + 'the config parameter "disable_collection" to true'
         )
         threading.Thread(target=send_usage_stats).start()
-    # The target expects that the tap generates UTF-8 encoded text.
-    input_messages = TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
-    if True or LOGGER.level == 0:
-        MemoryReporter().start()
+    # The target expects that the tap generates UTF-8 encoded text, which orjson decodes from the raw bytes.
+    # A larger read buffer saves syscalls on big tap outputs.
+    input_messages = BufferedReader(sys.stdin.buffer.raw, buffer_size=1 << 20)
     state = persist_messages(
         input_messages,
         config.get("destination_path", "."),
-        config.get("compression_method", None),
+        config.get("compression_method", "ZSTD"),
         config.get("streams_in_separate_folder", False),
-        int(config.get("file_size", -1))
+        int(config.get("file_size", -1)),
+        int(config.get("row_group_size", -1)),
+        config.get("validation_mode", "off" if config.get("skip_validation", False) else "strict"),
+        config.get("compression_level", None),
+        float(config.get("compression_skip_threshold", 0.9)),
+        config.get("memory_reporter", False),
+        float(config.get("dictionary_encode_threshold", 0)),
+        config.get("use_dictionary", True),
+        config.get("aggressive_gc", False),
     )
 
     emit_state(state)
@@ -0,0 +1,45 @@
+# cython: language_level=3
+"""Compiled implementation of flatten, see target_parquet.helpers.flatten for its documentation"""
+from decimal import Decimal
+from orjson import dumps as _dumps
+
+
+cpdef dict flatten(dict dictionary, str parent_key="", str sep="__", object json_fields=()):
+    cdef dict out
+    cdef list stack
+    cdef dict d
+    cdef str pk
+    cdef object k, v, new_key
+    cdef bint convert = False
+    if not parent_key:
+        for v in dictionary.values():
+            if type(v) is dict:
+                break
+            if type(v) is list or type(v) is Decimal:
+                convert = True
+        else:
+            if not convert:
+                return dictionary
+            return {
+                k: _dumps(v, default=str).decode() if type(v) is list else str(v) if type(v) is Decimal else v
+                for k, v in dictionary.items()
+            }
+    out = {}
+    stack = [(dictionary, parent_key)]
+    while stack:
+        d, pk = stack.pop()
+        for k, v in d.items():
+            new_key = f"{pk}{sep}{k}" if pk else k
+            if type(v) is dict:
+                if new_key in json_fields:
+                    out[new_key] = _dumps(v, default=str).decode()
+                else:
+                    stack.append((v, new_key))
+            elif type(v) is list:
+                out[new_key] = _dumps(v, default=str).decode()
+            elif type(v) is Decimal:
+                # fixing the Decimal parsing issue
+                out[new_key] = str(v)
+            else:
+                out[new_key] = v
+    return out
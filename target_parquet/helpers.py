@@ -1,17 +1,14 @@
-try:
-    from collections.abc import MutableMapping
-except ImportError:
-    from collections import MutableMapping  # deprecated in Python 3.3
-
+from collections import deque
 from decimal import Decimal
+from orjson import dumps as _dumps
+import pyarrow as pa
 import singer
 import os
-import simplejson
 
 LOGGER = singer.get_logger()
 LOGGER.setLevel(os.getenv("LOGGER_LEVEL", "INFO"))
 
-def flatten(dictionary, parent_key="", sep="__"):
+def flatten(dictionary, parent_key="", sep="__", json_fields=()):
     """Function that flattens a nested structure, using the separater given as parameter, or uses '__' as default
     E.g:
      dictionary =  {
@@ -29,26 +26,138 @@ def flatten(dictionary, parent_key="", sep="__"):
              'key_1': 1,
              'key_2__key_3': 2,
              'key_2__key_4__key_5': 3,
-             'key_2__key_4__key_6': "['10', '11']"
+             'key_2__key_4__key_6': '["10","11"]'
          }
+    A dictionary that is already flat, with no list or Decimal values to convert, is returned as is.
+    The dictionaries found under the keys in json_fields are stored as their JSON representation, like the lists.
     """
-    items = []
-    for k, v in dictionary.items():
-        new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, MutableMapping):
-            items.extend(flatten(v, new_key, sep=sep).items())
+    dumps = _dumps
+    if not parent_key:
+        convert = False
+        for v in dictionary.values():
+            if v.__class__ is dict:
+                break
+            if v.__class__ is list or v.__class__ is Decimal:
+                convert = True
         else:
-            items.append((new_key, simplejson.dumps(v, use_decimal=True) if type(v) is list else v))
-    all = dict(items)
-    # fixing the Decimal parsing issue
-    for k, v in all.items():
-        if type(v) is Decimal:
-            print("changed the "+v+ " to "+ str(v))
-            all[k] = str(v)
-    return all
+            if not convert:
+                return dictionary
+            return {
+                k: dumps(v, default=str).decode() if v.__class__ is list else str(v) if v.__class__ is Decimal else v
+                for k, v in dictionary.items()
+            }
+    out = {}
+    stack = deque([(dictionary, parent_key)])
+    while stack:
+        d, pk = stack.pop()
+        for k, v in d.items():
+            new_key = f"{pk}{sep}{k}" if pk else k
+            if v.__class__ is dict:
+                if new_key in json_fields:
+                    out[new_key] = dumps(v, default=str).decode()
+                else:
+                    stack.append((v, new_key))
+            elif v.__class__ is list:
+                out[new_key] = dumps(v, default=str).decode()
+            elif v.__class__ is Decimal:
+                # fixing the Decimal parsing issue
+                out[new_key] = str(v)
+            else:
+                out[new_key] = v
+    return out
+
+_py_flatten = flatten
+try:
+    # Compiled with Cython when the package is built with it available
+    from ._flatten import flatten
+except ImportError:
+    pass
+
+# Arrays, and objects without declared properties, are stored as their JSON representation, see flatten
+JSON_SCHEMA_TYPES = {
+    "integer": pa.int64(),
+    "number": pa.float64(),
+    "string": pa.string(),
+    "boolean": pa.bool_(),
+    "array": pa.string(),
+    "object": pa.string(),
+}
+
+def json_schema_types(schema):
+    """Function that returns the set of JSON schema types a property can take, following anyOf and oneOf"""
+    types = schema.get("type")
+    if types is None:
+        types = set()
+        for option in schema.get("anyOf", []) + schema.get("oneOf", []):
+            types.update(json_schema_types(option))
+        return types
+    if isinstance(types, str):
+        return {types}
+    return set(types)
+
+def object_properties(schema):
+    """Function that returns the properties of a property which can only be an object, following anyOf and oneOf,
+    or None when it can take other types or does not declare its properties"""
+    types = json_schema_types(schema)
+    types.discard("null")
+    if types != {"object"}:
+        return None
+    properties = dict(schema.get("properties") or {})
+    for option in schema.get("anyOf", []) + schema.get("oneOf", []):
+        properties.update(object_properties(option) or {})
+    return properties or None
+
+def arrow_type(schema):
+    """Function that maps the JSON schema of a property to a pyarrow type.
+    Returns None when the property can take several types which cannot be stored in the same column,
+    leaving them to be inferred from the data"""
+    types = json_schema_types(schema)
+    if not types:
+        return None
+    types.discard("null")
+    if not types:
+        return pa.null()
+    if types == {"integer", "number"}:
+        return pa.float64()
+    if len(types) > 1:
+        return None
+    return JSON_SCHEMA_TYPES.get(types.pop())
+
+# Keywords that restrict the values beyond their type. Formats are not enforced by the validators.
+SCHEMA_CONSTRAINTS = {
+    "$ref", "required", "enum", "const", "pattern", "minLength", "maxLength",
+    "minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum", "multipleOf",
+    "minItems", "maxItems", "uniqueItems", "contains", "minProperties", "maxProperties",
+    "patternProperties", "propertyNames", "dependencies", "not", "if",
+}
+
+def is_trivial_schema(schema):
+    """Function that tells whether a JSON schema does nothing more than declaring the types of the values,
+    in which case validating the records against it can be skipped
+    E.g:
+        {'type': 'object', 'properties': {'key_1': {'type': ['null', 'integer']}}} is trivial
+        {'type': 'object', 'properties': {'key_1': {'type': 'string', 'maxLength': 10}}} is not
+    """
+    stack = [schema]
+    while stack:
+        node = stack.pop()
+        if node is False:
+            return False
+        if node.__class__ is not dict:
+            continue
+        if not SCHEMA_CONSTRAINTS.isdisjoint(node) or node.get("additionalProperties") is False:
+            return False
+        stack.extend(node.get("properties", {}).values())
+        for keyword in ("anyOf", "oneOf", "allOf"):
+            stack.extend(node.get(keyword, []))
+        items = node.get("items", [])
+        stack.extend(items if items.__class__ is list else [items])
+        stack.append(node.get("additionalProperties"))
+    return True
 
 def flatten_schema(dictionary, parent_key="", sep="__"):
-    """Function that flattens a nested structure, using the separater given as parameter, or uses '__' as default
+    """Function that flattens a nested structure, using the separater given as parameter, or uses '__' as default,
+    along with the pyarrow type of each field
     E.g:
      dictionary =  {
                         'key_1': {'type': ['null', 'integer']},
@@ -77,10 +186,10 @@ def flatten_schema(dictionary, parent_key="", sep="__"):
                     }
     By calling the function with the dictionary above as parameter, you will get the following strucure:
         [
-             'key_1',
-             'key_2__key_3',
-             'key_2__key_4__key_5',
-             'key_2__key_4__key_6'
+             ('key_1', pa.int64()),
+             ('key_2__key_3', pa.string()),
+             ('key_2__key_4__key_5', pa.int64()),
+             ('key_2__key_4__key_6', pa.string())
         ]
     """
     items = []
@@ -89,10 +198,40 @@ def flatten_schema(dictionary, parent_key="", sep="__"):
         if "type" not in v:
             LOGGER.warning(
                 f'SCHEMA with limitted support on field {k}: {v}')
-        if "object" in v.get("type", []):
-            items.extend(flatten_schema(v.get("properties"),
+        properties = object_properties(v)
+        if properties:
+            items.extend(flatten_schema(properties,
                                  new_key,
                                  sep=sep))
         else:
-            items.append(new_key)
+            items.append((new_key, arrow_type(v)))
     return items
+
+def json_fields(dictionary, parent_key="", sep="__"):
+    """Function that returns the flattened names of the properties which can hold objects whose properties are not declared,
+    so that flatten stores them as their JSON representation instead of adding fields missing from the schema
+    E.g:
+     dictionary =  {
+                        'key_1': {'type': ['null', 'object']},
+                        'key_2': {
+                            'type': ['null', 'object'],
+                            'properties': {
+                                'key_3': {'type': ['null', 'string']},
+                                'key_4': {}
+                            }
+                        }
+                    }
+    By calling the function with the dictionary above as parameter, you will get {'key_1', 'key_2__key_4'}
+    """
+    fields = set()
+    for k, v in dictionary.items():
+        new_key = parent_key + sep + k if parent_key else k
+        properties = object_properties(v)
+        if properties:
+            fields.update(json_fields(properties, new_key, sep=sep))
+        else:
+            types = json_schema_types(v)
+            # a property without types can hold anything
+            if not types or "object" in types:
+                fields.add(new_key)
+    return fields
@@ -1,7 +1,8 @@
 import pytest
 import logging
+import pyarrow as pa
 
-from target_parquet.helpers import flatten, flatten_schema
+from target_parquet.helpers import flatten, flatten_schema, is_trivial_schema, json_fields, _py_flatten
 
 
 def test_flatten():
@@ -13,12 +14,39 @@ def test_flatten():
         "key_1": 1,
         "key_2__key_3": 2,
         "key_2__key_4__key_5": 3,
-        "key_2__key_4__key_6": "['10', '11']",
+        "key_2__key_4__key_6": '["10","11"]',
     }
 
     output = flatten(in_dict)
     assert output == expected
 
+def test_flatten_flat():
+    in_dict = {"key_1": 1, "key_2": "2", "key_3": None}
+    assert flatten(in_dict) is in_dict
+
+    in_dict["key_4"] = ["10", "11"]
+    expected = {"key_1": 1, "key_2": "2", "key_3": None, "key_4": '["10","11"]'}
+    assert flatten(in_dict) == expected
+
+def test_flatten_json_fields():
+    in_dict = {"key_1": {"key_2": 1}, "key_3": {"key_4": {"key_5": [1]}}}
+    expected = {"key_1": '{"key_2":1}', "key_3__key_4": '{"key_5":[1]}'}
+
+    assert flatten(in_dict, json_fields={"key_1", "key_3__key_4"}) == expected
+
+def test_flatten_compiled():
+    compiled = pytest.importorskip("target_parquet._flatten")
+    in_dict = {
+        "key_1": 1,
+        "key_2": {"key_3": 2, "key_4": {"key_5": 3, "key_6": ["10", "11"]}},
+        "key_7": {},
+    }
+    flat_dict = {"key_1": 1, "key_2": ["10", "11"]}
+
+    assert compiled.flatten(in_dict) == _py_flatten(in_dict)
+    assert compiled.flatten(flat_dict) == _py_flatten(flat_dict)
+    assert compiled.flatten(in_dict, json_fields={"key_2__key_4"}) == _py_flatten(in_dict, json_fields={"key_2__key_4"})
+
 def test_flatten_schema():
     in_dict = {
         'key_1': {'type': ['null', 'integer']},
@@ -46,10 +74,10 @@ def test_flatten_schema():
         }
     }
     expected = [
-             'key_1',
-             'key_2__key_3',
-             'key_2__key_4__key_5',
-             'key_2__key_4__key_6'
+             ('key_1', pa.int64()),
+             ('key_2__key_3', pa.string()),
+             ('key_2__key_4__key_5', pa.int64()),
+             ('key_2__key_4__key_6', pa.string())
     ]
 
     output = flatten_schema(in_dict)
@@ -94,13 +122,13 @@ def test_flatten_schema_2(caplog):
     }
 
     expected = [
-        'id',
-        'created_at',
-        'updated_at',
-        'email',
-        'last_surveyed',
-        'external_created_at',
-        'page_views_count'
+        ('id', pa.int64()),
+        ('created_at', pa.string()),
+        ('updated_at', pa.string()),
+        ('email', pa.string()),
+        ('last_surveyed', pa.string()),
+        ('external_created_at', pa.int64()),
+        ('page_views_count', pa.int64())
     ]
 
     with caplog.at_level(logging.WARNING):
@@ -112,4 +140,61 @@ def test_flatten_schema_2(caplog):
 
 def test_flatten_schema_empty():
     in_dict = dict()
-    assert list() == flatten_schema(in_dict)
\ No newline at end of file
+    assert list() == flatten_schema(in_dict)
+
+def test_flatten_schema_types():
+    in_dict = {
+        'price': {'type': ['null', 'integer', 'number']},
+        'flag': {'type': 'boolean'},
+        'tags': {'type': ['null', 'array'], 'items': {'type': 'string'}},
+        'extra': {'type': ['null', 'object']},
+        'mixed': {'type': ['integer', 'string']},
+        'nothing': {'type': 'null'},
+        'anything': {},
+        'payload': {'anyOf': [{'type': 'null'}, {'type': 'object', 'properties': {'id': {'type': 'integer'}}}]}
+    }
+    expected = [
+        ('price', pa.float64()),
+        ('flag', pa.bool_()),
+        ('tags', pa.string()),
+        ('extra', pa.string()),
+        ('mixed', None),
+        ('nothing', pa.null()),
+        ('anything', None),
+        ('payload__id', pa.int64())
+    ]
+
+    assert expected == flatten_schema(in_dict)
+
+def test_is_trivial_schema():
+    schema = {
+        'type': 'object',
+        'properties': {
+            'id': {'type': 'integer'},
+            'required': {'type': ['null', 'string'], 'format': 'date-time'},
+            'tags': {'type': 'array', 'items': {'anyOf': [{'type': 'null'}, {'type': 'string'}]}}
+        }
+    }
+    assert is_trivial_schema(schema)
+
+    schema['properties']['tags']['items']['anyOf'][1]['enum'] = ['a', 'b']
+    assert not is_trivial_schema(schema)
+
+    assert not is_trivial_schema({'type': 'object', 'properties': {}, 'required': ['id']})
+    assert not is_trivial_schema({'type': 'object', 'additionalProperties': False})
+
+def test_json_fields():
+    in_dict = {
+        'id': {'type': 'integer'},
+        'extra': {'type': ['null', 'object']},
+        'mixed': {'type': ['string', 'object'], 'properties': {'id': {'type': 'integer'}}},
+        'anything': {},
+        'payload': {
+            'anyOf': [
+                {'type': 'null'},
+                {'type': 'object', 'properties': {'id': {'type': 'integer'}, 'meta': {'type': 'object', 'properties': {}}}}
+            ]
+        }
+    }
+
+    assert json_fields(in_dict) == {'extra', 'mixed', 'anything', 'payload__meta'}
@@ -1,17 +1,17 @@
 import pytest
 import io
 from datetime import datetime
-from decimal import Decimal
 import pyarrow as pa
 from pyarrow.parquet import ParquetFile
 from pandas.testing import assert_frame_equal
 import json
+import fastjsonschema
 import logging
 
 # from os import walk
 import glob
 import os
-from target_parquet import persist_messages
+from target_parquet import DirectQueue, MessageType, create_column, merge_schemas, persist_messages
 
 #### TEMP DEBUG
 
@@ -22,7 +22,7 @@ def expected_df_1():
     return pa.table({
         'str': ['value1', 'value2', 'value3'],
         'int': [1, None, 3],
-        'decimal': [Decimal('0.1'), Decimal('0.2'), Decimal('0.3')],
+        'decimal': [0.1, 0.2, 0.3],
         'date': ['2021-06-11', '2021-06-12', '2021-06-13'],
         'datetime': ['2021-06-11T00:00:00.000000Z', '2021-06-12T00:00:00.000000Z', '2021-06-13T00:00:00.000000Z'],
         'boolean': [True, True, False]
@@ -73,6 +73,75 @@ def test_persist_messages(input_messages_1, expected_df_1):
 
     assert_frame_equal(df, expected_df_1)
 
+def test_persist_messages_bytes(input_messages_1, expected_df_1):
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.BufferedReader(io.BytesIO(input_messages_1.encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    df = ParquetFile(filename[0]).read().to_pandas()
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert_frame_equal(df, expected_df_1)
+
+def test_persist_messages_compression_skip(input_messages_1):
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.BufferedReader(io.BytesIO(input_messages_1.encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}", compression_method="zstd",
+                     compression_skip_threshold=0.01)
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*")]
+    compression = ParquetFile(filename[0]).metadata.row_group(0).column(0).compression
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert filename[0].endswith(".parquet")
+    assert compression == "UNCOMPRESSED"
+
+def test_persist_messages_dictionary_encoding():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    messages = ['{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"id": {"type": "integer"},"status": {"type": ["null", "string"]}}}, "key_properties": ["id"]}']
+    messages += [f'{{"type": "RECORD", "stream": "test", "record": {{"id": {i},"status": "active"}}}}' for i in range(20)]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}", dictionary_encode_threshold=0.1)
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    table = ParquetFile(filename[0]).read()
+
+    for f in filename:
+        os.remove(f)
+
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    # the columns keep their type unless asked for
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    default_table = ParquetFile(filename[0]).read()
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert table.schema.field("id").type == pa.int64()
+    assert table.schema.field("status").type == pa.dictionary(pa.int32(), pa.string())
+    assert table.column("status").to_pylist() == ["active"] * 20
+    assert default_table.schema.field("status").type == pa.string()
+
 def test_persist_messages_invalid_sort(input_messages_1_reorder):
     input_messages = io.TextIOWrapper(
         io.BytesIO(input_messages_1_reorder.encode()), encoding="utf-8"
@@ -81,3 +150,312 @@ def test_persist_messages_invalid_sort(input_messages_1_reorder):
     with pytest.raises(ValueError,
                        match="A record for stream test was encountered before a corresponding schema"):
         persist_messages(input_messages, "test_")
+
+def test_persist_messages_streams(monkeypatch):
+    monkeypatch.setattr("target_parquet.STREAM_SWITCH_FLUSH_SIZE", 2)
+    monkeypatch.setattr("target_parquet.RECORD_BATCH_SIZE", 2)
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    schema = '"schema": {"type": "object","properties": {"id": {"type": "integer"}}}, "key_properties": ["id"]'
+    messages = [f'{{"type": "SCHEMA","stream": "{stream}",{schema}}}' for stream in ("a", "b")]
+    for stream, ids in (("a", [1, 2]), ("b", [3, 4]), ("a", [5])):
+        messages += [f'{{"type": "RECORD", "stream": "{stream}", "record": {{"id": {i}}}}}' for i in ids]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    files = {os.path.basename(f).split("-")[0]: ParquetFile(f) for f in glob.glob(f"test_{timestamp}/*.parquet")}
+    # a stream is written as a row group when the next one starts with enough records buffered
+    row_groups = {stream: [f.metadata.row_group(i).num_rows for i in range(f.num_row_groups)] for stream, f in files.items()}
+    ids = {stream: f.read().column("id").to_pylist() for stream, f in files.items()}
+
+    for f in glob.glob(f"test_{timestamp}/*"):
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert row_groups == {"a": [2, 1], "b": [2]}
+    assert ids == {"a": [1, 2, 5], "b": [3, 4]}
+
+@pytest.mark.parametrize("start_methods", [None, ["spawn"]])
+def test_persist_messages_abort(monkeypatch, start_methods):
+    if start_methods is not None:
+        # the records are written in the same process where fork is not available
+        monkeypatch.setattr("target_parquet.get_all_start_methods", lambda: start_methods)
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    messages = ['{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"id": {"type": "integer"}}}, "key_properties": ["id"]}']
+    messages += [f'{{"type": "RECORD", "stream": "test", "record": {{"id": {i}}}}}' for i in range(10)]
+    messages += ['{"type": "RECORD", "stream": "test", "record": {"id": ']
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    with pytest.raises(Exception, match="Unable to parse"):
+        persist_messages(input_messages, f"test_{timestamp}", row_group_size=5)
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*")]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    # the records of the failed run are not written
+    assert filename == []
+
+def test_persist_messages_in_process(monkeypatch, input_messages_1, expected_df_1):
+    monkeypatch.setattr("target_parquet.get_all_start_methods", lambda: ["spawn"])
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.BufferedReader(io.BytesIO(input_messages_1.encode()))
+
+    state = persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    df = ParquetFile(filename[0]).read().to_pandas()
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert state == {"datetime": "2020-10-19"}
+    assert_frame_equal(df, expected_df_1)
+
+def test_persist_messages_draft4_schema():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    # draft 4 boolean exclusiveMaximum, as emitted by the Singer SQL taps
+    schema = '{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"amount": {"type": ["null", "number"], "exclusiveMaximum": true, "maximum": 100000000}}}, "key_properties": []}'
+    messages = [schema] + [f'{{"type": "RECORD", "stream": "test", "record": {{"amount": {a}}}}}' for a in (5, 12.34, 0.3)]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}", validation_mode="strict")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+    amounts = ParquetFile(filename[0]).read().column("amount").to_pylist()
+
+    input_messages = io.BufferedReader(io.BytesIO("\n".join([schema, messages[1].replace("5", "100000000")]).encode()))
+
+    with pytest.raises(fastjsonschema.JsonSchemaValueException):
+        persist_messages(input_messages, f"test_{timestamp}", validation_mode="strict")
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert amounts == [5, 12.34, 0.3]
+
+def test_persist_messages_objects():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    messages = [
+        '{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"meta": {"type": ["null", "object"]},"payload": {"anyOf": [{"type": "null"}, {"type": "object", "properties": {"a": {"type": "integer"}}}]}}}, "key_properties": []}',
+        '{"type": "RECORD", "stream": "test", "record": {"meta": {"a": 1, "b": [2]},"payload": {"a": 3}}}',
+        '{"type": "RECORD", "stream": "test", "record": {"meta": null,"payload": null}}',
+    ]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    table = ParquetFile(filename[0]).read()
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert table.to_pydict() == {"meta": ['{"a":1,"b":[2]}', None], "payload__a": [3, None]}
+
+def test_persist_messages_validation():
+    messages = [
+        '{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"name": {"type": ["null", "string"]}}}, "key_properties": []}',
+        '{"type": "RECORD", "stream": "test", "record": {"name": {"x": 1}}}',
+    ]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    # the records are validated by default, even against a schema that only declares types
+    with pytest.raises(fastjsonschema.JsonSchemaValueException):
+        persist_messages(input_messages, "test_")
+
+def row_groups_per_file(streams, **kwargs):
+    """Persists the records of the given streams, a list of stream names and record counts,
+    returning the sizes of the row groups of each file, in the order the files were created"""
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    schema = '"schema": {"type": "object","properties": {"id": {"type": "integer"}}}, "key_properties": ["id"]'
+    messages = [f'{{"type": "SCHEMA","stream": "{stream}",{schema}}}' for stream in sorted(set(s for s, _ in streams))]
+    for stream, count in streams:
+        messages += [f'{{"type": "RECORD", "stream": "{stream}", "record": {{"id": {i}}}}}' for i in range(count)]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}", **kwargs)
+
+    row_groups = []
+    for f in sorted(glob.glob(f"test_{timestamp}/*.parquet"), key=lambda f: f.split("-", 1)[1]):
+        metadata = ParquetFile(f).metadata
+        row_groups.append((os.path.basename(f).split("-")[0], [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]))
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+    return row_groups
+
+def test_persist_messages_row_groups():
+    assert row_groups_per_file([("a", 2500)], row_group_size=700, file_size=1500) == [
+        ("a", [700, 700, 100]),
+        ("a", [700, 300]),
+    ]
+    assert row_groups_per_file([("a", 2500)], file_size=1000) == [
+        ("a", [1000]),
+        ("a", [1000]),
+        ("a", [500]),
+    ]
+
+def test_persist_messages_row_groups_interleaved():
+    assert row_groups_per_file([("a", 1200), ("b", 500), ("a", 900)], row_group_size=1000, file_size=2000) == [
+        ("a", [1000, 1000]),
+        ("b", [500]),
+        ("a", [100]),
+    ]
+    # interleaved records are kept buffered
+    assert row_groups_per_file([("a", 1), ("b", 1)] * 50) == [
+        ("a", [50]),
+        ("b", [50]),
+    ]
+
+def test_persist_messages_row_groups_stream_switch(monkeypatch):
+    monkeypatch.setattr("target_parquet.STREAM_SWITCH_FLUSH_SIZE", 1000)
+    # a stream is written when the next one starts with enough records buffered,
+    # the records of each stream being sent in batches of 1000
+    assert row_groups_per_file([("a", 1200), ("b", 500), ("a", 900), ("b", 100)]) == [
+        ("a", [2000, 100]),
+        ("b", [600]),
+    ]
+
+def test_persist_messages_writer_failure():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    messages = ['{"type": "SCHEMA","stream": "s","schema": {"type": "object","properties": {"any": {}}}, "key_properties": []}']
+    messages += [f'{{"type": "RECORD", "stream": "s", "record": {{"any": {value}}}}}' for value in ('"a"', '"b"', '"c"', 1)]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    # the second row group mixes strings and integers, which cannot be stored in the same column
+    with pytest.raises(Exception, match="exit code 1"):
+        persist_messages(input_messages, f"test_{timestamp}", row_group_size=2)
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*")]
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    assert filename == []
+
+def test_persist_messages_schema_compiled_once(monkeypatch, input_messages_1, expected_df_1):
+    compiled = []
+    compile = fastjsonschema.compile
+    monkeypatch.setattr("fastjsonschema.compile", lambda *args, **kwargs: compiled.append(args) or compile(*args, **kwargs))
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.BufferedReader(io.BytesIO(input_messages_1.encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    df = ParquetFile(filename[0]).read().to_pandas()
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    # the schema is sent twice without changes
+    assert len(compiled) == 1
+    assert_frame_equal(df, expected_df_1)
+
+def test_persist_messages_compression(input_messages_1):
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    input_messages = io.BufferedReader(io.BytesIO(input_messages_1.encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}", compression_method="zstd")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*")]
+    compression = ParquetFile(filename[0]).metadata.row_group(0).column(0).compression
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    # the compression is internal to the file
+    assert filename[0].endswith(".parquet")
+    assert compression == "ZSTD"
+
+def test_persist_messages_partially_typed():
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+
+    messages = ['{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"amount": {"type": "number"},"any": {}}}, "key_properties": []}']
+    messages += [f'{{"type": "RECORD", "stream": "test", "record": {{"amount": {i}, "any": "x"}}}}' for i in range(1000)]
+    messages += ['{"type": "RECORD", "stream": "test", "record": {"amount": 12.5, "any": "y"}}']
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    persist_messages(input_messages, f"test_{timestamp}")
+
+    filename = [f for f in glob.glob(f"test_{timestamp}/*.parquet")]
+
+    table = ParquetFile(filename[0]).read()
+
+    for f in filename:
+        os.remove(f)
+    os.rmdir(f"test_{timestamp}")
+
+    # the declared types are kept when those of other fields are inferred
+    assert table.schema.field("amount").type == pa.float64()
+    assert table.column("amount").to_pylist()[-2:] == [999, 12.5]
+    assert table.schema.field("any").type == pa.string()
+
+def test_merge_schemas():
+    schemas = [
+        pa.schema([("id", pa.int64()), ("any", pa.null())]),
+        pa.schema([("id", pa.int64()), ("any", pa.int64())]),
+        pa.schema([("id", pa.int64()), ("any", pa.float64())]),
+    ]
+    assert merge_schemas(schemas) == pa.schema([("id", pa.int64()), ("any", pa.float64())])
+
+    with pytest.raises(ValueError, match="The values of field any have incompatible types"):
+        merge_schemas(schemas + [pa.schema([("id", pa.int64()), ("any", pa.string())])])
+
+def test_create_column():
+    assert create_column([1, 12.0, None], pa.int64()).to_pylist() == [1, 12, None]
+    assert create_column([None], pa.int64()).type == pa.int64()
+    assert create_column([1, 2.5], None).to_pylist() == [1, 2.5]
+
+    # the floats with a fractional part are not truncated
+    with pytest.raises(pa.ArrowInvalid):
+        create_column([1, 12.7], pa.int64())
+    with pytest.raises(pa.ArrowTypeError):
+        create_column([True], pa.int64())
+
+@pytest.mark.parametrize("validation_mode", ["lax", "off"])
+def test_persist_messages_integer_truncation(validation_mode):
+    messages = [
+        '{"type": "SCHEMA","stream": "test","schema": {"type": "object","properties": {"id": {"type": "integer"}}}, "key_properties": []}',
+        '{"type": "RECORD", "stream": "test", "record": {"id": 12.7}}',
+    ]
+    input_messages = io.BufferedReader(io.BytesIO("\n".join(messages).encode()))
+
+    with pytest.raises(Exception, match="exit code 1"):
+        persist_messages(input_messages, "test_", validation_mode=validation_mode)
+
+def test_persist_messages_interleaved_batches(monkeypatch):
+    monkeypatch.setattr("target_parquet.get_all_start_methods", lambda: ["spawn"])
+    batches = []
+
+    class RecordingQueue(DirectQueue):
+        def put(self, message, timeout=None):
+            if message[0] == MessageType.RECORD_BATCH:
+                batches.append((message[1], len(message[2])))
+            super().put(message, timeout)
+
+    monkeypatch.setattr("target_parquet.DirectQueue", RecordingQueue)
+
+    # the records of interleaved streams are still sent in full batches
+    assert row_groups_per_file([("a", 1), ("b", 1)] * 1500) == [("a", [1500]), ("b", [1500])]
+    assert batches == [("a", 1000), ("b", 1000), ("a", 500), ("b", 500)]